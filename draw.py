@@ -8,136 +8,292 @@ Set the following env vars:
     EMAIL_APP_PASS: generated application password (not normal login password)
     PARTY: yaml file containing participants, their emails, and forbidden picks
 """
+import logging
 import os
 import smtplib
-from random import randint
-from yaml import safe_load
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from random import shuffle
+from typing import Optional
+from yaml import load
+try:
+    # libyaml's C parser, when PyYAML was built with it
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 # read email from env vars
 EMAIL = os.getenv('EMAIL')
 # read email app password from env vars (different from your "normal" password)
 EMAIL_APP_PASS = os.getenv('EMAIL_APP_PASS')
 
+log = logging.getLogger(__name__)
+
+def _load_party():
+    """
+    Loads the PARTY yaml.
+
+    Returns:
+        dict: participant name -> info
+    """
+    with open(os.getenv('PARTY'), 'r', encoding="utf-8") as yam:
+        return load(yam, Loader=_Loader)
+
 class Party():
     """Class representing the collection of participants in secret santa."""
 
-    def __init__(self):
+    __slots__ = ('people',)
+
+    def __init__(self, data):
         self.people = []
-        with open(os.getenv('PARTY'), 'r', encoding="utf-8") as yam:
-            data = safe_load(yam)
-            for name, info in data.items():
-                self.people.append(Person(name, info))
+        for name, info in data.items():
+            self.people.append(Person(name, info['email'], info['forbidden']))
 
+@dataclass(slots=True)
 class Person():
     """Class representing a single participant in secret santa."""
 
-    def __init__(self, name, info):
-        self.name = name
-        self.email = info['email']
-        self.forbidden = info['forbidden']
-        self.giftee = None
+    name: str
+    email: str
+    forbidden: list[str]
+    giftee: Optional[str] = None
+    # forbidden as a set, for membership tests
+    forbidden_set: frozenset[str] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.forbidden = list(self.forbidden)
+        self.forbidden_set = frozenset(self.forbidden)
 
 class Hat():
     """Class representing hat of names."""
 
-    def __init__(self):
-        with open(os.getenv('PARTY'), 'r', encoding="utf-8") as yam:
-            data = safe_load(yam)
-            self.names = [person for person in data]
+    __slots__ = ('names',)
+
+    def __init__(self, data):
+        self.names = set(data)
+
+    def check(self, group):
+        """
+        Quick check for parties that obviously can't be drawn, so they fail
+        with a clear reason. Everyone needs at least one allowed giftee, and
+        every name in the hat needs at least one allowed giver.
+
+        Passing doesn't guarantee a valid drawing exists; draw() still raises
+        if it can't find one.
+
+        Args:
+            group (Party)
+
+        Raises:
+            ValueError: if the group fails any of the checks
+        """
+        # number of participants allowed to draw each name
+        givers = dict.fromkeys(self.names, 0)
+        for participant in group.people:
+            allowed = self.names - {participant.name} - participant.forbidden_set
+            if not allowed:
+                raise ValueError(f"{participant.name} has no valid giftee.")
+            for name in allowed:
+                givers[name] += 1
+        for name, count in givers.items():
+            if not count:
+                raise ValueError(f"Nobody is allowed to draw {name}.")
 
     def draw(self, group):
         """
         Each participant in the group will draw names from the hat.
-        Tries to avoid themselves and forbidden.
+        Avoids themselves and forbidden.
+
+        Treats the drawing as a bipartite matching between givers and names
+        in the hat, built by augmenting paths. Candidate order is shuffled so
+        the result is random.
 
         Args:
             group (Party)
+
+        Raises:
+            ValueError: if no valid drawing exists for the group
         """
+        # allowed giftees for every participant, in random order
+        allowed = {}
         for participant in group.people:
-            # prune hat before drawing
-            pruned = []
-            # remove person drawing
-            try:
-                self.names.remove(participant.name)
-                pruned.append(participant.name)
-            except ValueError:
-                pass
-            # remove forbidden
-            for name in participant.forbidden:
-                try:
-                    self.names.remove(name)
-                    pruned.append(name)
-                except ValueError:
-                    pass
-            # if none left, try to reconcile
-            if len(self.names) == 0:
-                # take last pruned and try to make a viable swap
-                giftee = pruned.pop()
-                # look at party (not current person or their forbidden)
-                for other in [p for p in group.people \
-                    if p.name != group.name and p.name not in participant.forbidden]:
-                    # see if their giftee works for current person
-                    if giftee not in other.forbidden and \
-                        other.giftee not in participant.forbidden and \
-                        other.giftee != participant.name:
-                        # swap
-                        new_giftee = other.giftee
-                        other.giftee = giftee
-                        giftee = new_giftee
-                        break
-            else:
-                # draw
-                giftee = self.names.pop(randint(0, len(self.names)-1))
-            participant.giftee = giftee
-            # replace pruned
-            self.names.extend(pruned)
-
-def email(participant):
+            candidates = list(self.names - {participant.name} - participant.forbidden_set)
+            shuffle(candidates)
+            allowed[participant.name] = candidates
+
+        # giftee name -> giver name
+        giver_of = {}
+
+        def augment(giver):
+            """Find a giftee for giver, bumping earlier givers if needed."""
+            seen = set()
+            # givers along the current path, each with its remaining candidates
+            stack = [(giver, iter(allowed[giver]))]
+            # name taken by each giver on the stack
+            path = []
+            while stack:
+                _, candidates = stack[-1]
+                for name in candidates:
+                    if name in seen:
+                        continue
+                    seen.add(name)
+                    path.append(name)
+                    if name not in giver_of:
+                        # free name found, shift everyone along the path
+                        for (current, _), taken in zip(stack, path):
+                            giver_of[taken] = current
+                        return True
+                    # try to find the name's current giver another giftee
+                    stack.append((giver_of[name], iter(allowed[giver_of[name]])))
+                    break
+                else:
+                    # dead end, back up
+                    stack.pop()
+                    if path:
+                        path.pop()
+            return False
+
+        givers = [participant.name for participant in group.people]
+        shuffle(givers)
+        for giver in givers:
+            if not augment(giver):
+                raise ValueError(f"No valid drawing exists: {giver} can't get a giftee.")
+
+        giftee_of = {giver: name for name, giver in giver_of.items()}
+        for participant in group.people:
+            participant.giftee = giftee_of[participant.name]
+
+# messages to send before reconnecting, to stay under per-session limits
+MAX_PER_CONNECTION = 100
+# concurrent connections, well under gmail's limit
+MAX_WORKERS = 8
+
+def build_message(sender, subject, participant):
     """
-    Sends email from host EMAIL to person, informing of giftee drawn.
+    Builds email from sender to person, informing of giftee drawn.
+
+    Args:
+        sender (str): host email address
+        subject (str): email subject
+        participant (Person): party participant
+
+    Returns:
+        EmailMessage: email ready to send
+    """
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['Subject'] = subject
+    msg['To'] = participant.email
+    msg.set_content(f"Hello {participant.name}!\n\n"
+                    f"You are the Secret Santa for {participant.giftee}!\n")
+    return msg
+
+def send_all(people):
+    """
+    Sends every participant their email, spread across a pool of workers.
+    Each worker keeps its own logged-in connection, reconnecting every
+    MAX_PER_CONNECTION messages or if the server drops it.
 
     Only works with gmail as-written.
 
     Args:
-        participant (Person): party participant
+        people (list[Person]): party participants
+
+    Raises:
+        smtplib.SMTPAuthenticationError: if the host EMAIL can't log in
     """
-    # build email
-    subject = 'Secret Santa'
-    body = (f"Hello {participant.name}!\n\n"
-            f"You are the Secret Santa for {participant.giftee}!\n\n")
+    if not people:
+        return
 
-    # bring everything together
-    email_text = (f"From: {EMAIL}\n"
-                    f"To: {participant.email}\n"
-                    f"Subject: {subject}\n"
-                    f"{body}")
+    local = threading.local()
+    # every connection opened, so they can all be closed at the end
+    servers = []
+    lock = threading.Lock()
+    auth_failed = threading.Event()
 
-    try:
-        # send email
+    def connect():
+        """Opens a logged-in connection for the current worker."""
+        old = getattr(local, 'server', None)
+        if old is not None:
+            with lock:
+                servers.remove(old)
+            try:
+                old.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            local.server = None
         server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-        server.ehlo()
-        server.login(EMAIL, EMAIL_APP_PASS)
-        server.sendmail(EMAIL, participant.email, email_text)
-        server.close()
-        print('Email sent!')
-    except smtplib.SMTPException as smtp_err:
-        print('Something went wrong during email...')
-        print(smtp_err)
+        try:
+            server.ehlo()
+            server.login(EMAIL, EMAIL_APP_PASS)
+        except (smtplib.SMTPException, OSError):
+            server.close()
+            raise
+        with lock:
+            servers.append(server)
+        local.server = server
+        local.sent = 0
 
-if __name__ == "__main__":
+    def send_one(participant):
+        """Sends one participant their email on this worker's connection."""
+        if auth_failed.is_set():
+            return
+        try:
+            if getattr(local, 'server', None) is None or local.sent >= MAX_PER_CONNECTION:
+                connect()
+            msg = build_message(EMAIL, 'Secret Santa', participant)
+            try:
+                local.server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # reconnect and retry once
+                connect()
+                local.server.send_message(msg)
+            local.sent += 1
+            log.info('Email sent to %s!', participant.name)
+        except smtplib.SMTPAuthenticationError:
+            # bad credentials won't work for anyone, stop the other workers
+            auth_failed.set()
+            raise
+        except (smtplib.SMTPException, OSError) as smtp_err:
+            log.warning('Something went wrong emailing %s: %s', participant.name, smtp_err)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(people))) as executor:
+            list(executor.map(send_one, people))
+    finally:
+        for server in servers:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+def main():
+    """Draws names for everyone in PARTY and emails them their giftee."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # parse PARTY yaml once for both the party and the hat
+    data = _load_party()
     # list of participants from PARTY yaml
-    party = Party()
-    # a simple list of names in PARTY for the "hat"
-    hat = Hat()
+    party = Party(data)
+    # a simple set of names in PARTY for the "hat"
+    hat = Hat(data)
 
     # run the secret santa drawing
-    hat.draw(party)
-
-    for person in party.people:
-        if not person.giftee:
-            print(f"Something isn't quite right. {person.name} got {person.giftee}.")
-            exit(1)
+    try:
+        hat.check(party)
+        hat.draw(party)
+    except ValueError as err:
+        log.error('%s', err)
+        exit(1)
 
     # email participants
-    for person in party.people:
-        email(person)
+    try:
+        send_all(party.people)
+    except smtplib.SMTPAuthenticationError as auth_err:
+        log.error("Couldn't log in as %s: %s", EMAIL, auth_err)
+        exit(1)
+
+if __name__ == "__main__":
+    main()